@@ -10,10 +10,13 @@ e.g. cosmo = astropy.cosmology.Planck15
 
 from astropy import cosmology
 
+def z_to_chi(z, cosmo=cosmology.Planck15):
+    return cosmo.comoving_distance(z).value
+
 def nz_to_gchi(z, nz, cosmo=cosmology.Planck15):
     from numpy import apply_along_axis, gradient, multiply, newaxis
     from scipy.integrate import cumtrapz
-    chi = cosmo.comoving_distance(z).value
+    chi = z_to_chi(z, cosmo)
     dchi = apply_along_axis(gradient, -1, chi)
     dz = apply_along_axis(gradient, -1, z)
     nchi = multiply(nz, dz/dchi)
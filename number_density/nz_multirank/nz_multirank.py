@@ -4,8 +4,9 @@ except:
     option_section = "options"
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
 #import matplotlib.pyplot as plt
-from nz_gz import nz_to_gchi
+from nz_gz import z_to_chi
 
 try:
     import astropy.io.fits as pyfits
@@ -16,43 +17,79 @@ except ImportError:
         raise RuntimeError("You need astropy installed to use the module \
         nz-multirank; try running: pip install astropy.")
 
-def load_histogram_form(ext, bin, upsampling):
+def histogram_trapz_weights(x, sample_bin, n_hist, integrand=1.0):
+    # Trapezoid-rule weights on the grid x, multiplied by the rest of the
+    # integrand and summed into the histogram bin each x sample is taken from,
+    # so that np.trapz(hist[..., sample_bin]*integrand, x) == hist @ weights.
+    # The weights are built once and every realisation and bin is then
+    # integrated by a single matrix product, with no upsampled temporaries.
+    dx = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += 0.5*dx
+    w[1:] += 0.5*dx
+    return np.bincount(sample_bin, weights=w*integrand, minlength=n_hist)
+
+def load_histogram_form(exts, n_bins, upsampling):
     # Load the various z columns.
     # The cosmosis code is expecting something it can spline
     # so  we need to give it more points than this - we will
     # give it the intermediate z values (which just look like a step
     # function)
-    zlow = ext.data['Z_LOW']
-    zhigh = ext.data['Z_HIGH']
+    # All realisations share the same z binning, so the z grid is taken from
+    # the first extension and the histograms of every realisation are read
+    # into one (n_realisations, n_bins, n_hist) array and normalised in a
+    # single pass.
+    # The histograms are returned at their original resolution together with
+    # the index of the histogram bin for each z sample, so the upsampled
+    # n(z) of a realisation is hist[i][:, sample_bin].
+    data = exts[0].data
+    zlow = data['Z_LOW']
+    zhigh = data['Z_HIGH']
+
+    hist = np.empty([len(exts), n_bins, len(zlow)])
+    for iext, ext in enumerate(exts):
+        data = ext.data
+        for ibin in range(n_bins):
+            hist[iext, ibin] = data['BIN{0}'.format(ibin+1)]
 
     if upsampling == 1:
-        z = ext.data['Z_MID']
-        nz = ext.data['BIN{0}'.format(bin)]
+        z = np.array(exts[0].data['Z_MID'], dtype=float)
+        sample_bin = np.arange(len(zlow))
 
     else:
         z = np.linspace(0.0, zhigh[-1], len(zlow) * upsampling)
-        sample_bin = np.digitize(z, zlow) - 1
-        nz = ext.data['BIN{0}'.format(bin)][sample_bin]
-
-    norm = np.trapz(nz, z)
-    nz /= norm
-
-    return z, nz
-
-def ensure_starts_at_zero(z, nz):
-    nbin = nz.shape[0]
+        # Samples below the first bin edge digitize to -1.  The original
+        # code indexed with that directly, so those samples took the value
+        # of the last histogram bin; that known quirk is kept here, but
+        # wrapped to a valid non-negative index for np.bincount.
+        sample_bin = (np.digitize(z, zlow) - 1) % len(zlow)
+
+    norm = hist @ histogram_trapz_weights(z, sample_bin, len(zlow))
+    hist /= norm[:, :, np.newaxis]
+
+    return z, hist, sample_bin
+
+def ensure_starts_at_zero(z, nz, sample_bin):
+    # Applied once in setup to the histograms of all realisations, so that
+    # execute only has to gather the sampled one.  Rather than padding every
+    # realisation with an extra sample, a zero histogram bin is appended and
+    # the z = 0 sample is pointed at it.
+    n_hist = nz.shape[-1]
+    nz[nz < 0] = 0
     if z[0] > 0.00000001:
         z_new = np.zeros(len(z) + 1)
         z_new[1:] = z
-        nz_new = np.zeros((nbin, len(z) + 1))
-        nz_new[:, 1:] = nz
-        nz_new[nz_new < 0] = 0
+        nz_new = np.zeros(nz.shape[:-1] + (n_hist + 1,))
+        nz_new[..., :n_hist] = nz
+        sample_bin_new = np.zeros(len(sample_bin) + 1, dtype=int)
+        sample_bin_new[0] = n_hist
+        sample_bin_new[1:] = sample_bin
     else:
         z_new = z
         nz_new = nz
-        nz_new[nz_new < 0] = 0
+        sample_bin_new = sample_bin
 
-    return z_new, nz_new
+    return z_new, nz_new, sample_bin_new
 
 def gridmorph(x, shape, bounds_sigma=3., k_norm=2):
     ''' Function to map the point set x to a uniform grid
@@ -85,10 +122,10 @@ def gridmorph(x, shape, bounds_sigma=3., k_norm=2):
     uu /= np.array(shape)
 
     # Now calculate the distance metric between all pairs
-    # of input points and grid points
+    # of input points and grid points, without building the
+    # (M,M,N) array of pairwise differences
 
-    dx = xx[:,np.newaxis,:] - uu[np.newaxis,:,:]
-    norm = np.sum(dx*dx,axis=2)  # Euclidean distance-squared
+    norm = cdist(xx, uu, 'sqeuclidean')  # Euclidean distance-squared
     if k_norm!=2.:
         norm = np.power(norm,k_norm/2.)
 
@@ -99,6 +136,10 @@ def gridmorph(x, shape, bounds_sigma=3., k_norm=2):
 
     return uu[iu]
 
+def grid_shape(uu):
+    # Number of distinct grid coordinates along each dimension of a uniform map
+    return tuple(len(np.unique(col)) for col in uu.T)
+
 def factors(f, dim=2):
     # Returns the squarest? possible factors for a given number of realisations
     if dim == 1:
@@ -136,57 +177,58 @@ def setup(options):
     resume_map = options.get_string(option_section, 'resume_map', "")
 
     # Determine number of realisations and array shapes from the file
-    nz_file = pyfits.open(nz_filename)
-    n_realisations = 0
-    n_bins = 0
-    istart = 0 # This is so we can index extensions by number instead of name. Much faster
-
-    for iext in np.arange(1, len(nz_file)):
-        if nz_file[iext].header['EXTNAME'].startswith('nz_{0}_realisation'.format(data_set)):
-            n_realisations += 1
-        if nz_file[iext].header['EXTNAME'].startswith('nz_{0}_realisation_0'.format(data_set)):
-            istart = iext
-            n_hist = len(nz_file[iext].data['Z_MID'])
-            for col in nz_file[iext].data.columns:
-                if col.name.startswith('BIN'):
-                    n_bins += 1
-
-    print('Multirank detected {0} realisations, {1} tomographic bins, {2} histogram bins.'.format(n_realisations, n_bins, n_hist))
-
-    # Initialize arrays for characteristic values from realisations
-    nz = np.zeros([n_realisations, n_bins, n_hist*upsampling])
-    gchi = np.zeros([n_realisations, n_bins, n_hist*upsampling])
-    nz_mean = np.zeros([n_realisations, n_bins])
-    inv_chi_mean = np.zeros([n_realisations, n_bins])
-
-    for iext in np.arange(n_realisations):
-
-        ext = nz_file[iext + istart]
-
-        for ibin in np.arange(n_bins):
-            zmid, nz[iext, ibin] = load_histogram_form(ext, ibin+1, upsampling)
-            nz_mean[iext, ibin] = np.trapz(nz[iext, ibin]*zmid, zmid)
-            if mode == 'invchi':
-                chi, gchi[iext, ibin] = nz_to_gchi(zmid, nz[iext, ibin])
-                inv_chi_mean[iext, ibin] = np.trapz(nz[iext, ibin]/chi, chi)
+    # Memory-map the file and load HDUs lazily; only the BIN columns of the
+    # realisations are ever read, so the tables are never parsed in full.
+    # Everything needed later is copied out into numpy arrays, so the file
+    # (and its memory map) is closed as soon as setup has read it.
+    with pyfits.open(nz_filename, memmap=True, lazy_load_hdus=True) as nz_file:
+        n_bins = 0
+
+        # Walk the HDU list once, reading each EXTNAME header a single time, and
+        # index the realisations by name so each one is a dict lookup.
+        realisation_prefix = 'nz_{0}_realisation'.format(data_set)
+        hdu_by_name = {}
+        for hdu in nz_file[1:]:
+            extname = hdu.header.get('EXTNAME', '')
+            if extname.startswith(realisation_prefix):
+                hdu_by_name[extname] = hdu
+        n_realisations = len(hdu_by_name)
+        exts = [hdu_by_name['{0}_{1}'.format(realisation_prefix, i)] for i in range(n_realisations)]
+
+        # Table shape and column names come from the header alone.
+        n_hist = exts[0].header['NAXIS2']
+        for name in exts[0].columns.names:
+            if name.startswith('BIN'):
+                n_bins += 1
+
+        print('Multirank detected {0} realisations, {1} tomographic bins, {2} histogram bins.'.format(n_realisations, n_bins, n_hist))
+
+        zmid, nz_hist, sample_bin = load_histogram_form(exts, n_bins, upsampling)
+
+    # Characteristic values of every realisation and bin, integrated over
+    # the upsampled grid directly from the histograms.  The mean z of every
+    # bin is saved to the block, but <1/chi> is only used for ranking, so it
+    # is only computed in invchi mode and for the ranked bins.
+    nz_mean = nz_hist @ histogram_trapz_weights(zmid, sample_bin, n_hist, zmid)
 
     if mode == 'mean':
         xx = nz_mean[:,bin_ranks-1]
     if mode == 'invchi':
-        xx = inv_chi_mean[:,bin_ranks-1]
+        # Only the z -> chi map of the shared grid is needed here, not g(chi).
+        chi = z_to_chi(zmid)
+        xx = nz_hist[:,bin_ranks-1] @ histogram_trapz_weights(chi, sample_bin, n_hist, 1/chi)
     if mode == 'external':
         xx = np.load(saved_stats)
 
+    zmid, nz_hist, sample_bin = ensure_starts_at_zero(zmid, nz_hist, sample_bin)
+
     map_shape = factors(n_realisations, dim=dimensions)
 
     # Read previously computed uniform map or compute a new one.
     if resume:
         try:
             uu = np.load(resume_map)
-            uu_loaded_dim = np.zeros(uu.shape[-1])
-            for idim in range(uu.shape[-1]):
-                uu_loaded_dim[idim] = len(np.unique(uu[:,idim]))
-            print('Found uniform map of dimensions ' + str(uu_loaded_dim))
+            print('Found uniform map of dimensions ' + str(grid_shape(uu)))
         except:
             print('Tried to resume using previous uniform map but could not find it.')
             print('Generating a new one of dimensions ' + str(map_shape) + ' with tomographic bins ' + str(bin_ranks))
@@ -198,18 +240,34 @@ def setup(options):
         uu = gridmorph(xx, map_shape)
 
     assert dimensions == uu.shape[-1], "Loaded uniform map was generated with a different dimensionality."
-    assert map_shape[0] == len(np.unique(uu[:,0])), "Loaded uniform map has a different shape than the one computed here."
-    assert map_shape[1] == len(np.unique(uu[:,1])), "Loaded uniform map has a different shape than the one computed here."
+    assert tuple(map_shape) == grid_shape(uu), "Loaded uniform map has a different shape than the one computed here."
+
+    # Invert the mapping: uu gives the grid point of each realisation, so
+    # scattering the realisation indices into the grid cells gives the
+    # realisation for each cell in O(n) without any searching in execute.
+    cells = np.ravel_multi_index(np.floor(uu*map_shape).astype(int).T, map_shape)
+    assert len(np.unique(cells)) == n_realisations, "Uniform map does not assign exactly one realisation to each grid point."
+    realisation_grid = np.empty(n_realisations, dtype=int)
+    realisation_grid[cells] = np.arange(n_realisations)
+    realisation_grid = realisation_grid.reshape(map_shape)
 
     # create config dictionary with mapped realisations and return it
     config = {}
     config['sample'] = data_set.upper()
-    config['nz'] = nz
+    # The ranking statistics above are computed in double precision; the
+    # stored histograms are only gathered and handed to splines downstream,
+    # so single precision (~1e-7 relative) is ample and halves their memory.
+    config['nz'] = nz_hist.astype(np.float32)
+    config['sample_bin'] = sample_bin
     config['nz_mean'] = nz_mean
     config['zmid'] = zmid
-    config['uniform_grid'] = uu
+    config['realisation_grid'] = realisation_grid
     config['dimensions'] = dimensions
     config['map_shape'] = map_shape
+    # Datablock keys used on every sample, formatted once here
+    config['rank_names'] = ['rank_hyperparm_{}'.format(idim+1) for idim in range(dimensions)]
+    config['bin_names'] = ['bin_{0}'.format(ibin+1) for ibin in range(n_bins)]
+    config['mean_z_names'] = ['mean_z_{0}'.format(ibin+1) for ibin in range(n_bins)]
 
     return config
 
@@ -219,37 +277,38 @@ def execute(block, config):
     # range of values rank_hyperparm_i can take, [0, 1)
 
     nz = config['nz']
+    sample_bin = config['sample_bin']
 
     zmid = config['zmid']
-    uu = config['uniform_grid']
+    realisation_grid = config['realisation_grid']
     pz = 'NZ_' + config['sample']
     nz_mean = config['nz_mean']
     nbins = nz.shape[1]
     dimensions = config['dimensions']
     map_shape = config['map_shape']
+    rank_names = config['rank_names']
+    bin_names = config['bin_names']
+    mean_z_names = config['mean_z_names']
 
     # Extract coordinates from sampled hyperparameters and find index from map
 
-    ranks = [block['ranks', 'rank_hyperparm_{}'.format(idim+1)] for idim in range(dimensions)]
-    coordinates = [(int(ranks[idim]*map_shape[idim]) + 0.5)/map_shape[idim] for idim in range(dimensions)]
-    uu_index = [np.argwhere(uu[:,idim] == coordinates[idim]).flatten() for idim in range(dimensions)]
-
-    index = uu_index[-1]
-    for idim in range(dimensions-1):
-        index = np.intersect1d(index, uu_index[idim], assume_unique=True)
-    index = int(index)
+    ranks = [block['ranks', name] for name in rank_names]
+    # A rank of exactly 1 would land one past the last cell, so clip it in.
+    cell = tuple(min(int(ranks[idim]*map_shape[idim]), map_shape[idim] - 1) for idim in range(dimensions))
+    index = int(realisation_grid[cell])
 
     # Extract sampled nz
-    z, nz_sampled = ensure_starts_at_zero(zmid, nz[index])
+    z = zmid
+    nz_sampled = nz[index][:, sample_bin].astype(np.float64)
 
     # Write info to datablock
     block[pz, 'nbin'] = nbins
     block[pz, 'z'] = z
     block[pz, 'nz'] = len(z)
 
-    for ibin in np.arange(nbins):
-        block[pz, 'bin_{0}'.format(ibin+1)] = nz_sampled[ibin]
-        block['ranks', 'mean_z_{0}'.format(ibin+1)] = nz_mean[index, ibin]
+    for ibin in range(nbins):
+        block[pz, bin_names[ibin]] = nz_sampled[ibin]
+        block['ranks', mean_z_names[ibin]] = nz_mean[index, ibin]
 
     block['ranks', 'realisation_id'] = index
 
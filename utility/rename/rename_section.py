@@ -17,9 +17,12 @@ def setup(options):
 
 def execute(block, config):
     source, dest = config
+    # Resolve the block methods once per call rather than once per section
+    copy_section = block._copy_section
+    delete_section = block._delete_section
     for (s, d) in zip(source, dest):
-        block._copy_section(s, d)
-        block._delete_section(s)
+        copy_section(s, d)
+        delete_section(s)
     return 0
 
 